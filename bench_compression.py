@@ -0,0 +1,110 @@
+"""Benchmark for the compression of bulk responses.
+
+This script measures the compression ratio and the CPU time needed to compress
+and decompress CHECK-like responses of different sizes. Each row compresses a
+sequence of responses on one stream, like a connection would, so the effect of
+the preset dictionary and the shared stream context is included.
+
+Usage example:
+
+    $ python bench_compression.py
+"""
+
+import random
+import time
+import zlib
+
+from chat_compression import DICTIONARY, Compressor, Decompressor
+
+PAYLOAD_SIZES = [128, 512, 1024, 4096, 16384, 65536, 262144]
+LEVELS = [1, 6, 9]
+RESPONSES_PER_STREAM = 20
+
+WORDS = ("hi hello how are you doing today see you later the meeting is at "
+         "noon can we talk tomorrow thanks sure ok great lunch project "
+         "deadline review done").split()
+SENDERS = [f"user{i}" for i in range(50)]
+
+
+def make_response(size, rng):
+    """Generate a CHECK-like response of roughly the given size.
+
+    Args:
+        size (int): The size of the response in bytes.
+        rng (random.Random): The random number generator to use.
+
+    Returns:
+        bytes: Newline separated "<sender>: <message>" lines.
+    """
+    lines = []
+    length = 0
+    while length < size:
+        line = f"{rng.choice(SENDERS)}: {' '.join(rng.choices(WORDS, k=rng.randint(3, 15)))}"
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines).encode()[:size]
+
+
+def bench(size, level):
+    """Compress and decompress a stream of responses of one size.
+
+    Args:
+        size (int): The size of each response in bytes.
+        level (int): The zlib compression level.
+
+    Returns:
+        tuple: The compression ratio, the compression time and the
+               decompression time per response in microseconds, and the
+               compression throughput in MB/s.
+    """
+    rng = random.Random(size)
+    responses = [make_response(size, rng) for _ in range(RESPONSES_PER_STREAM)]
+    compressor = Compressor(threshold=0, level=level)
+    decompressor = Decompressor()
+
+    start = time.process_time()
+    frames = [compressor.pack(response) for response in responses]
+    compress_time = time.process_time() - start
+
+    start = time.process_time()
+    for frame in frames:
+        decompressor.feed(frame)
+    decompress_time = time.process_time() - start
+
+    total = sum(map(len, responses))
+    ratio = total / sum(map(len, frames))
+    return (ratio,
+            compress_time / len(responses) * 1e6,
+            decompress_time / len(responses) * 1e6,
+            total / compress_time / 1e6 if compress_time else float("inf"))
+
+
+def bench_without_context(size, level):
+    """Compress every response on its own, without dictionary or context.
+
+    Args:
+        size (int): The size of each response in bytes.
+        level (int): The zlib compression level.
+
+    Returns:
+        float: The compression ratio.
+    """
+    rng = random.Random(size)
+    responses = [make_response(size, rng) for _ in range(RESPONSES_PER_STREAM)]
+    compressed = sum(len(zlib.compress(response, level)) for response in responses)
+    return sum(map(len, responses)) / compressed
+
+
+if __name__ == "__main__":
+    print(f"Preset dictionary: {len(DICTIONARY)} bytes, "
+          f"{RESPONSES_PER_STREAM} responses per stream\n")
+    print(f"{'size':>8} {'level':>5} {'ratio':>7} {'ratio w/o ctx':>14} "
+          f"{'compress us':>12} {'decompress us':>14} {'MB/s':>8}")
+    for payload_size in PAYLOAD_SIZES:
+        for zlib_level in LEVELS:
+            stream_ratio, compress_us, decompress_us, throughput = \
+                bench(payload_size, zlib_level)
+            plain_ratio = bench_without_context(payload_size, zlib_level)
+            print(f"{payload_size:>8} {zlib_level:>5} {stream_ratio:>7.2f} "
+                  f"{plain_ratio:>14.2f} {compress_us:>12.1f} "
+                  f"{decompress_us:>14.1f} {throughput:>8.1f}")
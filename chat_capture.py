@@ -0,0 +1,118 @@
+"""Module implementing the capture file format of the chat server.
+
+A ChatServer running in capture mode records every inbound command with a
+CommandCapture, and the replay tool reads the file back with read_capture.
+Both live here so that the replay tool does not depend on the server.
+"""
+
+import struct
+import time
+from collections import defaultdict
+from threading import Lock
+
+CAPTURE_MAGIC = b"CHATCAP1"
+CAPTURE_HEADER = struct.Struct("<8sd")
+CAPTURE_RECORD = struct.Struct("<dIH")
+
+
+class CommandCapture:
+    """Records inbound client commands to a compact binary log.
+
+    The log starts with a header containing a magic value and the wall clock
+    time the capture was started. Each record consists of the seconds elapsed
+    since the start of the capture, a connection number, the payload length and
+    the raw payload. A record with an empty payload marks a closed connection.
+    The token of ADMIN requests is redacted, so capture files can be shared.
+
+    Attributes:
+        path (str): The path of the capture file.
+        lock (threading.Lock): A lock used to serialize writes to the file.
+    """
+
+    def __init__(self, path):
+        """Initialize a new CommandCapture object and write the file header.
+
+        Args:
+            path (str): The path of the capture file.
+        """
+        self.path = path
+        self.lock = Lock()
+        self._file = open(path, "wb")
+        self._start = time.monotonic()
+        self._connections = {}
+        self._next_connection = 0
+        self._file.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, time.time()))
+
+    def record(self, address, payload):
+        """Append an inbound command to the capture.
+
+        Args:
+            address (tuple): The address of the client that sent the command.
+            payload (bytes): The raw command as received from the client.
+        """
+        elapsed = time.monotonic() - self._start
+        if payload.startswith(b"ADMIN "):
+            parts = payload.split(b" ", 2)
+            parts[1] = b"<redacted>"
+            payload = b" ".join(parts)
+        with self.lock:
+            if self._file.closed:
+                return
+            connection = self._connections.get(address)
+            if connection is None:
+                connection = self._next_connection
+                self._connections[address] = connection
+                self._next_connection += 1
+            self._file.write(CAPTURE_RECORD.pack(elapsed, connection, len(payload)))
+            self._file.write(payload)
+
+    def close_connection(self, address):
+        """Record that the connection from the given address was closed.
+
+        Args:
+            address (tuple): The address of the client.
+        """
+        with self.lock:
+            if address not in self._connections:
+                return
+        self.record(address, b"")
+        with self.lock:
+            del self._connections[address]
+
+    def close(self):
+        """Flush and close the capture file."""
+        with self.lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+def read_capture(path):
+    """Read all records from a capture file.
+
+    Args:
+        path (str): The path of the capture file.
+
+    Returns:
+        dict: A dictionary mapping connection numbers to lists of
+              (elapsed, payload) tuples in recorded order.
+
+    Raises:
+        ValueError: If the file is not a valid capture file.
+    """
+    connections = defaultdict(list)
+    with open(path, "rb") as capture_file:
+        header = capture_file.read(CAPTURE_HEADER.size)
+        if len(header) != CAPTURE_HEADER.size or \
+                CAPTURE_HEADER.unpack(header)[0] != CAPTURE_MAGIC:
+            raise ValueError(f"'{path}' is not a chat capture file")
+        while True:
+            record = capture_file.read(CAPTURE_RECORD.size)
+            if len(record) < CAPTURE_RECORD.size:
+                break
+            elapsed, connection, length = CAPTURE_RECORD.unpack(record)
+            payload = capture_file.read(length)
+            if len(payload) < length:
+                # Truncated trailing record, e.g. the server was killed
+                break
+            connections[connection].append((elapsed, payload))
+    return dict(connections)
@@ -14,8 +14,11 @@ Authors:
 import socket
 import sys
 import threading
+import zlib
 from queue import Queue
 
+from chat_compression import COMPRESSION_METHOD, Decompressor
+
 
 class ChatClient:
     """
@@ -34,13 +37,19 @@ class ChatClient:
     stop_event (threading.Event): An event to signal the response handling
                                   thread to stop.
     response_thread (threading.Thread): A thread to handle server messages.
+    compress (bool): Whether to ask the server to compress bulk responses.
+    decompressor (chat_compression.Decompressor): The decompressor for
+                                                  compressed responses, or None
+                                                  if compression is not used.
     """
-    def __init__(self, server_ip):
+    def __init__(self, server_ip, compress=False):
         """
         Initializes a new instance of the ChatClient class.
 
         Args:
         server_ip (str): The IP address of the server.
+        compress (bool): Whether to ask the server to compress bulk responses
+                         (default is False).
         """
         self.server_ip = server_ip
         self.server_port = 2900
@@ -50,6 +59,8 @@ class ChatClient:
         self.stop_event = threading.Event()
         self.response_thread = threading.Thread(target=self.handle_server_message,
                                                 daemon=True)
+        self.compress = compress
+        self.decompressor = None
 
     def register(self, client_id):
         """
@@ -70,13 +81,32 @@ class ChatClient:
                 print("ERROR: Client ID must have at least one character")
                 return False
 
-            self.client_socket.sendall(client_id.encode())
+            request = client_id
+            if self.compress:
+                request += f" COMPRESS={COMPRESSION_METHOD}"
+            self.client_socket.sendall(request.encode())
             response = self.client_socket.recv(1024).decode()
 
-            if response == "SUCCESS":
+            if self.compress and response == "SUCCESS":
+                # The server does not support compression and registered the
+                # whole request as client ID, register again without it
+                self.client_socket.send(b"DISCONNECT")
+                self.client_socket.close()
+                self.client_socket = None
+                self.compress = False
+                return self.register(client_id)
+            elif response.startswith("SUCCESS"):
+                if response == f"SUCCESS COMPRESS={COMPRESSION_METHOD}":
+                    self.decompressor = Decompressor()
                 self.client_id = client_id
                 print(f"Client {client_id} registered")
                 return True
+            elif response.startswith("BUSY"):
+                # The server closed the connection, reconnect on the next try
+                print(f"{response}")
+                self.client_socket.close()
+                self.client_socket = None
+                return False
             else:
                 print(f"{response}")
                 return False
@@ -96,23 +126,31 @@ class ChatClient:
             try:
                 # Set a timeout of 1 second
                 self.client_socket.settimeout(1)
-                message = self.client_socket.recv(1024).decode()
+                data = self.client_socket.recv(1024)
                 # Reset the timeout
                 self.client_socket.settimeout(None)
+                if not data:
+                    raise ConnectionResetError
+                if self.decompressor:
+                    # Responses are framed, a read may hold several or a part
+                    messages = [frame.decode() for frame in self.decompressor.feed(data)]
+                else:
+                    messages = [data.decode()]
 
-                if message == "SHUTDOWN":
+                if "SHUTDOWN" in messages:
                     print(
                         "\n!!! You have been disconnected from the server because"
                         " it has been shut down. Press any key to exit.!!!")
                     self.stop_event.set()
                     self.disconnect()
                     break
-                else:
+                for message in messages:
                     self.response_queue.put(message)
             except socket.timeout:
                 # If a timeout occurs, just continue the loop
                 continue
-            except ConnectionResetError:
+            except (ConnectionResetError, ValueError, zlib.error):
+                # A corrupted response stream cannot be recovered either
                 print(
                     "\n!!! Unexpectedly lost connection to server. "
                     "Press any key to exit.!!!")
@@ -130,15 +168,22 @@ class ChatClient:
         response = self.response_queue.get()
         print(f"Other clients logged in:\n{response}")
 
-    def send_message(self, recipient, message):
-        """Sends a message to the specified recipient utilizing "SEND" request.
+    def send_message(self, recipient, message, ttl=None):
+        """Sends a message to the specified recipient utilizing "SEND" request,
+        or "SENDTTL" request if the message should expire.
 
         Args:
             recipient (str): The ID of the client to send the message to.
             message (str): The message to send.
+            ttl (float): The number of seconds after which the message expires
+                         if the recipient has not fetched it (default is None,
+                         the server's default applies).
 
         """
-        request = f"SEND {recipient} {message}"
+        if ttl is None:
+            request = f"SEND {recipient} {message}"
+        else:
+            request = f"SENDTTL {ttl:g} {recipient} {message}"
         self.client_socket.send(request.encode())
 
     def check_messages(self):
@@ -154,6 +199,25 @@ class ChatClient:
         else:
             print(response)
 
+    def show_history(self, peer, keyword=None):
+        """Sends a "HISTORY" request to the server to retrieve the recent
+        messages exchanged with another client.
+
+        Args:
+            peer (str): The ID of the other client of the conversation.
+            keyword (str): If given, only messages containing this word are
+                           shown.
+        """
+        request = f"HISTORY {peer}"
+        if keyword:
+            request += f" search={keyword}"
+        self.client_socket.send(request.encode())
+        response = self.response_queue.get()
+        if response == "EMPTY":
+            print("No messages")
+        else:
+            print(response)
+
     def disconnect(self):
         """
         Disconnect from the server by sending a "DISCONNECT" request and setting
@@ -185,7 +249,8 @@ class ChatClient:
 
         The method then enters a loop to process user input. The user can choose
         to list other logged-in clients, send a message to another client, check
-        for incoming messages, or quit the chat system. Invalid selections will
+        for incoming messages, show the history of a conversation, or quit the
+        chat system. Invalid selections will
         result in an error message.
 
         """
@@ -202,7 +267,8 @@ class ChatClient:
             print("1: List other logged in clients")
             print("2: Send message")
             print("3: Check incoming messages")
-            print("4: Quit")
+            print("4: Show conversation history")
+            print("5: Quit")
 
             selection = input("Your selection: ")
 
@@ -224,6 +290,10 @@ class ChatClient:
                 elif selection == "3":
                     self.check_messages()
                 elif selection == "4":
+                    peer = input("Show history with: ")
+                    keyword = input("Search for word (optional): ").strip()
+                    self.show_history(peer, keyword or None)
+                elif selection == "5":
                     self.quit()
                 else:
                     print("Invalid selection. Please try again.")
@@ -0,0 +1,120 @@
+"""Module implementing compression of bulk responses.
+
+Clients may ask for compression when registering by appending
+"COMPRESS=zlib" to their client ID. The server then compresses responses above
+a size threshold with a zlib stream that lives as long as the connection, so
+that later responses benefit from the context of earlier ones. Both sides
+start from a preset dictionary of strings common in the chat protocol.
+
+Once compression has been negotiated, every response, including "SHUTDOWN",
+is sent as a frame: a flag byte (FRAME_PLAIN or FRAME_COMPRESSED), the length
+of the data as a 4 byte big-endian integer and the data. Clients that did not
+ask for compression get unframed responses as before.
+"""
+
+import struct
+import zlib
+
+COMPRESSION_METHOD = "zlib"
+FRAME_HEADER = struct.Struct(">BI")
+FRAME_PLAIN = 0
+FRAME_COMPRESSED = 1
+
+# Preset dictionary shared by server and client. zlib prefers the most common
+# strings at the end.
+DICTIONARY = (b"Only you at the moment!\nEMPTY\nERROR: \n#1 #2 #3 #4 #5 #6 #7 #8 "
+              b"#9 #10 2025-2026-01-02-03-04-05-06-07-08-09-10-11-12- 00:10:20:"
+              b"30:40:50: the you and to is it that for this what are\n: ")
+
+
+def plain_frame(data):
+    """Wrap a response in an uncompressed frame.
+
+    Unlike Compressor.pack, this does not touch the compression stream and may
+    be used from any thread.
+
+    Args:
+        data (bytes): The response.
+
+    Returns:
+        bytes: The frame.
+    """
+    return FRAME_HEADER.pack(FRAME_PLAIN, len(data)) + data
+
+
+class Compressor:
+    """The compressing side of a connection.
+
+    Attributes:
+        threshold (int): Responses shorter than this number of bytes are sent
+                         uncompressed.
+    """
+
+    def __init__(self, threshold=512, level=6):
+        """Initialize a new Compressor object.
+
+        Args:
+            threshold (int): The minimum response size in bytes to compress
+                             (default is 512).
+            level (int): The zlib compression level (default is 6).
+        """
+        self.threshold = threshold
+        self._stream = zlib.compressobj(level, zdict=DICTIONARY)
+
+    def pack(self, data):
+        """Turn a response into a frame.
+
+        Args:
+            data (bytes): The uncompressed response.
+
+        Returns:
+            bytes: A compressed frame, or a plain frame if `data` is below the
+                   threshold.
+        """
+        if len(data) < self.threshold:
+            return plain_frame(data)
+        # A sync flush ends the frame on a byte boundary while keeping the
+        # compression context for the next frame
+        compressed = self._stream.compress(data) + self._stream.flush(zlib.Z_SYNC_FLUSH)
+        return FRAME_HEADER.pack(FRAME_COMPRESSED, len(compressed)) + compressed
+
+
+class Decompressor:
+    """The decompressing side of a connection.
+
+    Received bytes are fed in as they arrive; frames split across or sharing
+    a read are reassembled.
+    """
+
+    def __init__(self):
+        """Initialize a new Decompressor object."""
+        self._stream = zlib.decompressobj(zdict=DICTIONARY)
+        self._buffer = b""
+
+    def feed(self, data):
+        """Add received bytes and return the responses completed by them.
+
+        Args:
+            data (bytes): The bytes received from the server.
+
+        Returns:
+            list: The uncompressed responses of all complete frames, in order.
+
+        Raises:
+            ValueError: If a frame has an unknown flag.
+        """
+        self._buffer += data
+        responses = []
+        while len(self._buffer) >= FRAME_HEADER.size:
+            flag, length = FRAME_HEADER.unpack_from(self._buffer)
+            if flag not in (FRAME_PLAIN, FRAME_COMPRESSED):
+                raise ValueError(f"Invalid frame flag {flag}")
+            end = FRAME_HEADER.size + length
+            if len(self._buffer) < end:
+                break
+            payload = self._buffer[FRAME_HEADER.size:end]
+            self._buffer = self._buffer[end:]
+            if flag == FRAME_COMPRESSED:
+                payload = self._stream.decompress(payload)
+            responses.append(payload)
+        return responses
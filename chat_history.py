@@ -0,0 +1,300 @@
+"""Module implementing a server-side message history.
+
+This module defines the MessageHistory class, which keeps the messages
+exchanged in every conversation so that clients can retrieve them again after
+their mailbox has been drained by a CHECK request. Each conversation is indexed
+by sequence number and time, and an inverted index allows searching for
+keywords.
+
+Client IDs are not authenticated and become free again when a client
+disconnects, so the ChatServer discards all conversations of a client when it
+disconnects. Otherwise the next client registering the same ID could read them.
+
+Usage example:
+
+    >>> history = MessageHistory()
+    >>> history.add("alice", "bob", "Hello Bob")
+    1
+    >>> [entry[3] for entry in history.query("bob", "alice", keyword="hello")]
+    ['Hello Bob']
+"""
+
+import re
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from threading import Lock
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def conversation_key(client_a, client_b):
+    """Return the key identifying the conversation between two clients.
+
+    Args:
+        client_a (str): The ID of the first client.
+        client_b (str): The ID of the second client.
+
+    Returns:
+        tuple: The client IDs in sorted order, so that both directions of a
+               conversation share the same key.
+    """
+    return (client_a, client_b) if client_a <= client_b else (client_b, client_a)
+
+
+class Conversation:
+    """The stored messages of a single conversation.
+
+    Messages are kept in parallel lists ordered by sequence number. As sequence
+    numbers are contiguous, a sequence number maps directly to a list position,
+    and as timestamps never decrease, time ranges are found by bisection.
+
+    Attributes:
+        first_seq (int): The sequence number of the oldest stored message.
+        timestamps (list): The time each message was stored.
+        senders (list): The ID of the sender of each message.
+        texts (list): The text of each message.
+        word_index (dict): An inverted index mapping lower-case words to the
+                           ascending sequence numbers of the messages
+                           containing them.
+    """
+
+    def __init__(self):
+        """Initialize an empty Conversation."""
+        self.first_seq = 1
+        self.timestamps = []
+        self.senders = []
+        self.texts = []
+        self.word_index = {}
+
+    @property
+    def next_seq(self):
+        """int: The sequence number the next message will get."""
+        return self.first_seq + len(self.texts)
+
+    def append(self, timestamp, sender, text):
+        """Store a message and index its words.
+
+        Args:
+            timestamp (float): The time the message was sent.
+            sender (str): The ID of the sender.
+            text (str): The message text.
+
+        Returns:
+            int: The sequence number of the message.
+        """
+        seq = self.next_seq
+        if self.timestamps and timestamp < self.timestamps[-1]:
+            # Keep the time index sorted if the clock goes backwards
+            timestamp = self.timestamps[-1]
+        self.timestamps.append(timestamp)
+        self.senders.append(sender)
+        self.texts.append(text)
+        for word in set(WORD_PATTERN.findall(text.lower())):
+            self.word_index.setdefault(word, []).append(seq)
+        return seq
+
+    def trim(self, keep):
+        """Drop the oldest messages so that at most `keep` remain.
+
+        Args:
+            keep (int): The number of messages to keep.
+        """
+        drop = len(self.texts) - keep
+        if drop <= 0:
+            return
+        new_first_seq = self.first_seq + drop
+        # Only words of dropped messages can have stale index entries
+        for text in self.texts[:drop]:
+            for word in set(WORD_PATTERN.findall(text.lower())):
+                seqs = self.word_index.get(word)
+                if seqs is None:
+                    continue
+                del seqs[:bisect_left(seqs, new_first_seq)]
+                if not seqs:
+                    del self.word_index[word]
+        del self.timestamps[:drop]
+        del self.senders[:drop]
+        del self.texts[:drop]
+        self.first_seq = new_first_seq
+
+    def entry(self, seq):
+        """Return a stored message.
+
+        Args:
+            seq (int): The sequence number of the message.
+
+        Returns:
+            tuple: A (seq, timestamp, sender, text) tuple.
+        """
+        pos = seq - self.first_seq
+        return seq, self.timestamps[pos], self.senders[pos], self.texts[pos]
+
+    def seq_range(self, after=None, before=None, since=None, until=None):
+        """Return the sequence numbers matching all given bounds.
+
+        Args:
+            after (int): Only messages with a greater sequence number.
+            before (int): Only messages with a smaller sequence number.
+            since (float): Only messages stored at or after this time.
+            until (float): Only messages stored at or before this time.
+
+        Returns:
+            range: The matching sequence numbers in ascending order.
+        """
+        low, high = self.first_seq, self.next_seq
+        if after is not None:
+            low = max(low, after + 1)
+        if before is not None:
+            high = min(high, before)
+        if since is not None:
+            low = max(low, self.first_seq + bisect_left(self.timestamps, since))
+        if until is not None:
+            high = min(high, self.first_seq + bisect_right(self.timestamps, until))
+        return range(low, max(low, high))
+
+
+class MessageHistory:
+    """A bounded, indexed store of the messages of all conversations.
+
+    Besides the limits per conversation, at most `max_total_messages`
+    messages are kept overall; the least recently used conversations are
+    discarded to stay below it. A message of the 126 characters the chat
+    client allows takes about 700 bytes including the indexes, so the default
+    of 2 million messages bounds memory use to roughly 1.4 GB.
+
+    Attributes:
+        max_messages (int): The maximum number of messages kept per
+                            conversation. Older messages are discarded.
+        max_conversations (int): The maximum number of conversations kept. The
+                                 least recently used conversation is discarded
+                                 first.
+        max_total_messages (int): The maximum number of messages kept in all
+                                  conversations together.
+        total_messages (int): The number of messages currently kept.
+        conversations (collections.OrderedDict): A dictionary mapping
+                                                 conversation keys to
+                                                 Conversation objects, least
+                                                 recently used first.
+        participants (dict): A dictionary mapping client IDs to the set of
+                             keys of their conversations.
+        lock (threading.Lock): A lock used to ensure thread safety.
+    """
+
+    def __init__(self, max_messages=10000, max_conversations=10000,
+                 max_total_messages=2000000):
+        """Initialize a new MessageHistory object.
+
+        Args:
+            max_messages (int): The maximum number of messages kept per
+                                conversation (default is 10000).
+            max_conversations (int): The maximum number of conversations kept
+                                     (default is 10000).
+            max_total_messages (int): The maximum number of messages kept
+                                      overall (default is 2000000).
+        """
+        self.max_messages = max_messages
+        self.max_conversations = max_conversations
+        self.max_total_messages = max_total_messages
+        self.total_messages = 0
+        self.conversations = OrderedDict()
+        self.participants = {}
+        self.lock = Lock()
+
+    def _remove(self, key):
+        """Delete a conversation and its participant entries.
+
+        Must be called with the lock held.
+
+        Args:
+            key (tuple): The key of the conversation.
+        """
+        self.total_messages -= len(self.conversations.pop(key).texts)
+        for client_id in set(key):
+            keys = self.participants[client_id]
+            keys.discard(key)
+            if not keys:
+                del self.participants[client_id]
+
+    def add(self, sender, recipient, text, timestamp=None):
+        """Store a message sent from one client to another.
+
+        Args:
+            sender (str): The ID of the sender.
+            recipient (str): The ID of the recipient.
+            text (str): The message text.
+            timestamp (float): The time the message was sent (default is now).
+
+        Returns:
+            int: The sequence number of the message in its conversation.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        key = conversation_key(sender, recipient)
+        with self.lock:
+            conversation = self.conversations.get(key)
+            if conversation is None:
+                conversation = self.conversations[key] = Conversation()
+                for client_id in key:
+                    self.participants.setdefault(client_id, set()).add(key)
+                if len(self.conversations) > self.max_conversations:
+                    self._remove(next(iter(self.conversations)))
+            else:
+                self.conversations.move_to_end(key)
+            seq = conversation.append(timestamp, sender, text)
+            self.total_messages += 1
+            # Trim in batches so that the cost of shifting the lists is
+            # amortized over many messages
+            if len(conversation.texts) > self.max_messages + self.max_messages // 4:
+                self.total_messages -= len(conversation.texts) - self.max_messages
+                conversation.trim(self.max_messages)
+            # The conversation just used is the last one and is never evicted
+            while self.total_messages > self.max_total_messages and \
+                    len(self.conversations) > 1:
+                self._remove(next(iter(self.conversations)))
+            return seq
+
+    def query(self, client_a, client_b, after=None, before=None, since=None,
+              until=None, keyword=None, limit=50):
+        """Retrieve the newest messages of a conversation matching a query.
+
+        Args:
+            client_a (str): The ID of one participant.
+            client_b (str): The ID of the other participant.
+            after (int): Only messages with a greater sequence number.
+            before (int): Only messages with a smaller sequence number.
+            since (float): Only messages stored at or after this time.
+            until (float): Only messages stored at or before this time.
+            keyword (str): Only messages containing this word.
+            limit (int): The maximum number of messages to return
+                         (default is 50).
+
+        Returns:
+            list: Up to `limit` (seq, timestamp, sender, text) tuples in
+                  ascending sequence order.
+        """
+        key = conversation_key(client_a, client_b)
+        with self.lock:
+            conversation = self.conversations.get(key)
+            if conversation is None or limit <= 0:
+                return []
+            self.conversations.move_to_end(key)
+            seqs = conversation.seq_range(after, before, since, until)
+            if keyword is not None:
+                matches = conversation.word_index.get(keyword.lower(), [])
+                start = bisect_left(matches, seqs.start)
+                end = bisect_left(matches, seqs.stop)
+                seqs = matches[max(start, end - limit):end]
+            else:
+                seqs = seqs[-limit:]
+            return [conversation.entry(seq) for seq in seqs]
+
+    def discard_client(self, client_id):
+        """Delete all conversations a client took part in.
+
+        Args:
+            client_id (str): The ID of the client.
+        """
+        with self.lock:
+            for key in list(self.participants.get(client_id, ())):
+                self._remove(key)
@@ -0,0 +1,357 @@
+"""Module implementing the mailboxes of the chat server.
+
+This module defines the MailboxStore class, which holds the messages waiting
+to be fetched by a CHECK request. Messages may have a time to live; expired
+messages are removed in bulk with the help of a TimingWheel instead of
+scanning every mailbox. Mailboxes that have not been touched for a while are
+moved to compact files on disk and are loaded back when they are drained, so
+that memory use is proportional to the number of active clients.
+
+The store does no locking of its own; the ChatServer serializes all calls
+with its lock.
+"""
+
+import hashlib
+import math
+import os
+import shutil
+import struct
+import tempfile
+import time
+from collections import OrderedDict, deque
+
+# Expiry time, sender length and message length of a message on disk
+SPILL_RECORD = struct.Struct("<dHH")
+NO_EXPIRY = math.inf
+
+
+class TimingWheel:
+    """Schedules keys to be returned once their expiry time has passed.
+
+    Time is divided into ticks which are mapped onto a fixed number of slots.
+    Every slot maps expiry ticks to the keys expiring in them, so a key
+    expiring more than one revolution ahead simply waits in its slot. Advancing
+    the wheel only visits the slots of the elapsed ticks.
+
+    Attributes:
+        tick (float): The resolution of the wheel in seconds.
+        slots (list): The slots of the wheel, each a dictionary mapping expiry
+                      ticks to sets of keys.
+        current_tick (int): The last tick the wheel was advanced to.
+    """
+
+    def __init__(self, tick=1.0, size=3600, now=None):
+        """Initialize a new TimingWheel object.
+
+        Args:
+            tick (float): The resolution of the wheel in seconds (default
+                          is 1.0).
+            size (int): The number of slots (default is 3600).
+            now (float): The current time (default is time.time()).
+        """
+        self.tick = tick
+        self.slots = [{} for _ in range(size)]
+        self.current_tick = self._tick_of(time.time() if now is None else now)
+
+    def _tick_of(self, timestamp):
+        """Return the tick a point in time falls into.
+
+        Args:
+            timestamp (float): The point in time.
+
+        Returns:
+            int: The tick number.
+        """
+        return int(timestamp // self.tick)
+
+    def schedule(self, key, expires_at):
+        """Schedule a key to be returned after the given time.
+
+        Args:
+            key: The key to schedule, e.g. a client ID.
+            expires_at (float): The expiry time.
+        """
+        # Round up so that a key is never returned before its expiry time
+        expiry_tick = max(self._tick_of(expires_at) + 1, self.current_tick + 1)
+        slot = self.slots[expiry_tick % len(self.slots)]
+        slot.setdefault(expiry_tick, set()).add(key)
+
+    def advance(self, now):
+        """Advance the wheel and return the keys that expired.
+
+        Args:
+            now (float): The current time.
+
+        Returns:
+            set: The keys scheduled for the elapsed ticks.
+        """
+        target = self._tick_of(now)
+        expired = set()
+        # After a long pause, every slot has to be visited at most once
+        first = max(self.current_tick + 1, target - len(self.slots) + 1)
+        for tick in range(first, target + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for expiry_tick in [t for t in slot if t <= target]:
+                expired |= slot.pop(expiry_tick)
+        self.current_tick = max(self.current_tick, target)
+        return expired
+
+
+class MailboxStore:
+    """The mailboxes of all clients, with expiry and tiered storage.
+
+    Attributes:
+        idle_timeout (float): The number of seconds after which an untouched
+                              mailbox is moved to disk, or None to keep all
+                              mailboxes in memory.
+        spill_dir (str): The directory cold mailboxes are stored in.
+        hot (dict): A dictionary mapping client IDs to deques of
+                    (expires_at, sender, message) tuples kept in memory.
+        last_access (collections.OrderedDict): A dictionary mapping client IDs
+                                               of hot mailboxes to the time
+                                               they were last touched, least
+                                               recently touched first.
+        cold (set): The client IDs of mailboxes stored on disk.
+        wheel (TimingWheel): The wheel scheduling the expiry of messages.
+    """
+
+    def __init__(self, idle_timeout=300, spill_dir=None, tick=1.0):
+        """Initialize a new MailboxStore object.
+
+        Args:
+            idle_timeout (float): The number of seconds after which an
+                                  untouched mailbox is moved to disk (default
+                                  is 300), or None to disable this.
+            spill_dir (str): The directory for cold mailboxes (default is a
+                             new temporary directory, removed by close()).
+            tick (float): The resolution of message expiry in seconds
+                          (default is 1.0).
+        """
+        self.idle_timeout = idle_timeout
+        self._owns_spill_dir = spill_dir is None
+        self.spill_dir = spill_dir
+        self.hot = {}
+        self.last_access = OrderedDict()
+        self.cold = set()
+        self.wheel = TimingWheel(tick)
+
+    def __contains__(self, client_id):
+        """Return whether a client has a mailbox.
+
+        Args:
+            client_id (str): The ID of the client.
+
+        Returns:
+            bool: True if the client has a hot or cold mailbox.
+        """
+        return client_id in self.hot or client_id in self.cold
+
+    def _spill_path(self, client_id):
+        """Return the file a cold mailbox is stored in.
+
+        Args:
+            client_id (str): The ID of the client.
+
+        Returns:
+            str: The path of the mailbox file.
+        """
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="chat_mailboxes_")
+        # Hashed to a fixed length, client IDs may be longer than a file name
+        digest = hashlib.sha256(client_id.encode()).hexdigest()
+        return os.path.join(self.spill_dir, digest + ".mbx")
+
+    def put(self, client_id, sender, message, ttl=None, now=None):
+        """Add a message to a client's mailbox.
+
+        Messages for a cold mailbox are appended to its file without loading
+        it into memory.
+
+        Args:
+            client_id (str): The ID of the recipient.
+            sender (str): The ID of the sender.
+            message (str): The message text.
+            ttl (float): The number of seconds after which the message expires
+                         (default is None, the message never expires).
+            now (float): The current time (default is time.time()).
+
+        Raises:
+            ValueError: If `ttl` is not a positive finite number.
+        """
+        if ttl is not None and not (math.isfinite(ttl) and ttl > 0):
+            raise ValueError(f"Invalid time to live {ttl}")
+        now = time.time() if now is None else now
+        expires_at = NO_EXPIRY if ttl is None else now + ttl
+        if client_id in self.cold:
+            with open(self._spill_path(client_id), "ab") as mailbox_file:
+                mailbox_file.write(self._pack(expires_at, sender, message))
+            return
+
+        mailbox = self.hot.get(client_id)
+        if mailbox is None:
+            mailbox = self.hot[client_id] = deque()
+        mailbox.append((expires_at, sender, message))
+        self.last_access[client_id] = now
+        self.last_access.move_to_end(client_id)
+        if expires_at != NO_EXPIRY:
+            self.wheel.schedule(client_id, expires_at)
+
+    def drain(self, client_id, now=None):
+        """Remove and return all unexpired messages of a client's mailbox.
+
+        Args:
+            client_id (str): The ID of the client.
+            now (float): The current time (default is time.time()).
+
+        Returns:
+            list: The (sender, message) tuples in the order they were added.
+        """
+        now = time.time() if now is None else now
+        if client_id in self.cold:
+            entries = self._load(client_id)
+        else:
+            entries = self.hot.pop(client_id, ())
+            self.last_access.pop(client_id, None)
+        return [(sender, message) for expires_at, sender, message in entries
+                if expires_at > now]
+
+    def discard(self, client_id):
+        """Delete a client's mailbox.
+
+        A missing mailbox file is ignored, as the mailbox is gone either way.
+
+        Args:
+            client_id (str): The ID of the client.
+
+        Raises:
+            OSError: If the mailbox file exists but cannot be deleted. The
+                     mailbox is forgotten regardless.
+        """
+        self.hot.pop(client_id, None)
+        self.last_access.pop(client_id, None)
+        if client_id in self.cold:
+            self.cold.discard(client_id)
+            try:
+                os.remove(self._spill_path(client_id))
+            except FileNotFoundError:
+                pass
+
+    def expire(self, now=None):
+        """Remove the messages whose time to live has passed.
+
+        Only hot mailboxes with messages expiring in the elapsed ticks are
+        visited. Cold mailboxes are filtered when they are loaded.
+
+        Args:
+            now (float): The current time (default is time.time()).
+
+        Returns:
+            int: The number of removed messages.
+        """
+        now = time.time() if now is None else now
+        removed = 0
+        for client_id in self.wheel.advance(now):
+            mailbox = self.hot.get(client_id)
+            if mailbox is None:
+                continue
+            kept = deque(entry for entry in mailbox if entry[0] > now)
+            removed += len(mailbox) - len(kept)
+            if kept:
+                self.hot[client_id] = kept
+            else:
+                del self.hot[client_id]
+                del self.last_access[client_id]
+        return removed
+
+    def spill_idle(self, now=None):
+        """Move mailboxes untouched for longer than idle_timeout to disk.
+
+        Args:
+            now (float): The current time (default is time.time()).
+
+        Returns:
+            int: The number of mailboxes moved to disk.
+
+        Raises:
+            OSError: If a mailbox file cannot be written. The mailbox stays in
+                     memory and the mailboxes moved so far stay on disk.
+        """
+        if self.idle_timeout is None:
+            return 0
+        now = time.time() if now is None else now
+        spilled = 0
+        # Mailboxes are ordered by last access, so stop at the first active one
+        while self.last_access:
+            client_id, accessed = next(iter(self.last_access.items()))
+            if now - accessed < self.idle_timeout:
+                break
+            path = self._spill_path(client_id)
+            try:
+                with open(path, "wb") as mailbox_file:
+                    mailbox_file.write(b"".join(self._pack(*entry)
+                                                for entry in self.hot[client_id]))
+            except OSError:
+                # Keep the mailbox in memory, without a partial file
+                if os.path.exists(path):
+                    os.remove(path)
+                raise
+            del self.hot[client_id]
+            del self.last_access[client_id]
+            self.cold.add(client_id)
+            spilled += 1
+        return spilled
+
+    def close(self):
+        """Delete all cold mailboxes, including the spill directory if the
+        store created it."""
+        if self._owns_spill_dir and self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+        else:
+            for client_id in list(self.cold):
+                self.discard(client_id)
+        self.cold.clear()
+
+    @staticmethod
+    def _pack(expires_at, sender, message):
+        """Serialize a message for a mailbox file.
+
+        Args:
+            expires_at (float): The expiry time of the message.
+            sender (str): The ID of the sender.
+            message (str): The message text.
+
+        Returns:
+            bytes: The serialized message.
+        """
+        sender_bytes = sender.encode()
+        message_bytes = message.encode()
+        return (SPILL_RECORD.pack(expires_at, len(sender_bytes), len(message_bytes))
+                + sender_bytes + message_bytes)
+
+    def _load(self, client_id):
+        """Read and delete a cold mailbox.
+
+        Args:
+            client_id (str): The ID of the client.
+
+        Returns:
+            list: The (expires_at, sender, message) tuples of the mailbox.
+        """
+        path = self._spill_path(client_id)
+        with open(path, "rb") as mailbox_file:
+            data = mailbox_file.read()
+        os.remove(path)
+        self.cold.discard(client_id)
+
+        entries = []
+        offset = 0
+        while offset < len(data):
+            expires_at, sender_length, message_length = \
+                SPILL_RECORD.unpack_from(data, offset)
+            offset += SPILL_RECORD.size
+            sender = data[offset:offset + sender_length].decode()
+            offset += sender_length
+            message = data[offset:offset + message_length].decode()
+            offset += message_length
+            entries.append((expires_at, sender, message))
+        return entries
@@ -0,0 +1,259 @@
+"""Module implementing profiling and tracing hooks for the chat server.
+
+The ChatServer reports the phases of every command it handles (parsing,
+acquiring the lock, the mailbox operation and writing to the socket) to a
+DispatchHooks object. Listeners can be attached to it and detached again
+while the server is running:
+
+    - PhaseTimer aggregates the time spent per command and phase.
+    - SpanTracer exports every phase as a span to a JSON lines file.
+
+Independently of the hooks, the SamplingProfiler periodically samples the
+stacks of all threads to find out where the server spends its time.
+"""
+
+import json
+import math
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from threading import Lock, Thread
+
+_NO_PHASE = nullcontext()
+
+# Shorter sampling intervals would keep the profiler thread permanently busy
+MIN_SAMPLING_INTERVAL = 0.001
+
+
+class DispatchHooks:
+    """Notifies listeners about the phases of handled commands.
+
+    A listener is any object with a `phase_finished(command, phase, start,
+    duration)` method. The list of listeners is replaced rather than modified,
+    so that reading it needs no lock. Without listeners, `phase` returns a
+    shared no-op context manager and adds almost no overhead.
+
+    Attributes:
+        listeners (tuple): The currently attached listeners.
+    """
+
+    def __init__(self):
+        """Initialize a new DispatchHooks object without listeners."""
+        self.listeners = ()
+        self._lock = Lock()
+
+    def add(self, listener):
+        """Attach a listener.
+
+        Args:
+            listener: The listener to attach.
+        """
+        with self._lock:
+            self.listeners = self.listeners + (listener,)
+
+    def remove(self, listener):
+        """Detach a listener if it is attached.
+
+        Args:
+            listener: The listener to detach.
+        """
+        with self._lock:
+            self.listeners = tuple(item for item in self.listeners
+                                   if item is not listener)
+
+    def phase(self, command, phase):
+        """Return a context manager measuring a phase of a command.
+
+        Args:
+            command (str): The command being handled, e.g. "CHECK".
+            phase (str): The phase, one of "parse", "lock", "mailbox" and
+                         "write".
+
+        Returns:
+            A context manager reporting the phase to all listeners on exit.
+        """
+        if not self.listeners:
+            return _NO_PHASE
+        return self._measure(command, phase)
+
+    @contextmanager
+    def _measure(self, command, phase):
+        """Measure a phase and report it to the listeners.
+
+        Args:
+            command (str): The command being handled.
+            phase (str): The phase being measured.
+        """
+        start = time.time()
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - begin
+            for listener in self.listeners:
+                listener.phase_finished(command, phase, start, duration)
+
+
+class PhaseTimer:
+    """Aggregates the time spent per command and phase.
+
+    Attributes:
+        stats (dict): A dictionary mapping (command, phase) tuples to lists of
+                      [count, total seconds, maximum seconds].
+    """
+
+    def __init__(self):
+        """Initialize a new PhaseTimer object."""
+        self.stats = defaultdict(lambda: [0, 0.0, 0.0])
+        self._lock = Lock()
+
+    def phase_finished(self, command, phase, start, duration):
+        """Add a finished phase to the statistics.
+
+        Args:
+            command (str): The command that was handled.
+            phase (str): The phase that finished.
+            start (float): The UNIX time the phase started.
+            duration (float): The duration of the phase in seconds.
+        """
+        with self._lock:
+            entry = self.stats[(command, phase)]
+            entry[0] += 1
+            entry[1] += duration
+            entry[2] = max(entry[2], duration)
+
+    def report(self):
+        """Return the statistics as text.
+
+        Returns:
+            str: One line per command and phase with the count and the mean
+                 and maximum duration in microseconds.
+        """
+        with self._lock:
+            items = sorted(self.stats.items())
+        return "\n".join(f"{command} {phase}: n={count} "
+                         f"mean={total / count * 1e6:.1f}us max={peak * 1e6:.1f}us"
+                         for (command, phase), (count, total, peak) in items)
+
+
+class SpanTracer:
+    """Exports every phase as a span to a JSON lines file.
+
+    Attributes:
+        path (str): The path of the trace file.
+    """
+
+    def __init__(self, path):
+        """Initialize a new SpanTracer object and open the trace file.
+
+        Args:
+            path (str): The path of the trace file. Spans are appended.
+        """
+        self.path = path
+        self._file = open(path, "a")
+        self._lock = Lock()
+
+    def phase_finished(self, command, phase, start, duration):
+        """Write a span for a finished phase.
+
+        Args:
+            command (str): The command that was handled.
+            phase (str): The phase that finished.
+            start (float): The UNIX time the phase started.
+            duration (float): The duration of the phase in seconds.
+        """
+        span = json.dumps({"name": phase, "command": command,
+                           "thread": threading.current_thread().name,
+                           "start": start, "duration_us": duration * 1e6})
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(span + "\n")
+
+    def close(self):
+        """Flush and close the trace file."""
+        with self._lock:
+            self._file.close()
+
+
+class SamplingProfiler:
+    """Periodically samples the stacks of all threads.
+
+    Attributes:
+        interval (float): The time between two samples in seconds.
+        samples (int): The number of samples taken.
+        stacks (collections.Counter): The number of samples per stack, with
+                                      stacks in folded form ("outer;inner").
+    """
+
+    def __init__(self, interval=0.005):
+        """Initialize a new SamplingProfiler object.
+
+        Args:
+            interval (float): The time between two samples in seconds
+                              (default is 0.005).
+
+        Raises:
+            ValueError: If `interval` is not a finite number of at least
+                        MIN_SAMPLING_INTERVAL.
+        """
+        if not math.isfinite(interval) or interval < MIN_SAMPLING_INTERVAL:
+            raise ValueError(f"Invalid sampling interval {interval}")
+        self.interval = interval
+        self.samples = 0
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+        self._thread = Thread(target=self._run, name="SamplingProfiler",
+                              daemon=True)
+
+    def start(self):
+        """Start sampling in a background thread."""
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling and wait for the sampling thread to finish."""
+        self._stop_event.set()
+        self._thread.join()
+
+    def _run(self):
+        """Take samples until the profiler is stopped."""
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}"
+                                 f":{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def write_folded(self, path):
+        """Write the sampled stacks in folded format, e.g. for flame graphs.
+
+        Args:
+            path (str): The path of the output file.
+        """
+        with open(path, "w") as profile_file:
+            for stack, count in self.stacks.most_common():
+                profile_file.write(f"{stack} {count}\n")
+
+    def report(self, top=10):
+        """Return the functions seen most often on top of a stack.
+
+        Args:
+            top (int): The number of functions to report (default is 10).
+
+        Returns:
+            str: One line per function with its number of samples.
+        """
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        lines = [f"{self.samples} samples"]
+        lines += [f"{count:>6} {function}" for function, count in leaves.most_common(top)]
+        return "\n".join(lines)
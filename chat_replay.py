@@ -0,0 +1,312 @@
+"""Module implementing deterministic replay of captured chat traffic.
+
+This module reads a capture file written by a ChatServer running in capture
+mode and feeds the recorded commands back against one or two servers. Every
+recorded connection is replayed on its own connection, keeping the original
+order and (optionally scaled) timing of the commands. Throughput and the
+latency of commands answered by the server are reported, and when two
+servers are given the results are compared side by side.
+
+Responses of sessions that negotiated compression are framed and read
+exactly. Unframed responses are read until no more data arrives for
+QUIET_PERIOD seconds; their latency is measured up to the last byte received.
+As requests are not framed, commands sent in quick succession may be merged by
+the server and go unanswered; a connection waiting longer than
+RESPONSE_TIMEOUT seconds for a response is counted as an error.
+
+Usage example:
+
+    $ python chat_replay.py capture.bin 127.0.0.1:2900
+    $ python chat_replay.py capture.bin 127.0.0.1:2900 127.0.0.1:2901 --speed 10
+    $ python chat_replay.py capture.bin 127.0.0.1:2900 --max
+"""
+
+import argparse
+import select
+import socket
+import statistics
+import sys
+import time
+from threading import Thread, Lock
+
+from chat_capture import read_capture
+from chat_compression import COMPRESSION_METHOD, FRAME_HEADER
+
+# Commands the server answers with a reply whose latency is measured
+REPLYING_COMMANDS = {"LIST", "CHECK", "HISTORY", "ADMIN"}
+
+# Seconds without data after which an unframed response is considered complete
+QUIET_PERIOD = 0.02
+
+# Seconds to wait for a response before giving up on a connection
+RESPONSE_TIMEOUT = 5
+
+
+class ReplayResult:
+    """The outcome of replaying a capture against one server.
+
+    Attributes:
+        target (str): The "host:port" the capture was replayed against.
+        commands (int): The number of commands sent.
+        errors (int): The number of connections that failed.
+        rejected (int): The number of connections refused with "BUSY".
+        duration (float): The wall clock duration of the replay in seconds.
+        latencies (list): The round-trip times of answered commands in seconds.
+    """
+
+    def __init__(self, target):
+        """Initialize an empty ReplayResult.
+
+        Args:
+            target (str): The "host:port" the capture was replayed against.
+        """
+        self.target = target
+        self.commands = 0
+        self.errors = 0
+        self.rejected = 0
+        self.duration = 0.0
+        self.latencies = []
+
+    @property
+    def throughput(self):
+        """float: The number of commands sent per second."""
+        return self.commands / self.duration if self.duration else 0.0
+
+    def percentile(self, percent):
+        """Return a latency percentile in milliseconds.
+
+        Args:
+            percent (int): The percentile to compute, between 1 and 99.
+
+        Returns:
+            float: The latency percentile, or 0.0 if nothing was measured.
+        """
+        if len(self.latencies) < 2:
+            return self.latencies[0] * 1000 if self.latencies else 0.0
+        return statistics.quantiles(self.latencies, n=100,
+                                   method="inclusive")[percent - 1] * 1000
+
+    def summary(self):
+        """Return the reported figures as a dictionary.
+
+        Returns:
+            dict: Throughput in commands per second and latencies in
+                  milliseconds.
+        """
+        return {
+            "commands": self.commands,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "duration_s": self.duration,
+            "throughput_cmd_s": self.throughput,
+            "latency_mean_ms": statistics.fmean(self.latencies) * 1000
+            if self.latencies else 0.0,
+            "latency_p50_ms": self.percentile(50),
+            "latency_p95_ms": self.percentile(95),
+            "latency_p99_ms": self.percentile(99),
+            "latency_max_ms": max(self.latencies) * 1000 if self.latencies else 0.0,
+        }
+
+
+def read_response(client_socket, framed):
+    """Read one complete response from the server.
+
+    Args:
+        client_socket (socket.socket): The connection to the server.
+        framed (bool): Whether the session negotiated compression, so that
+                       responses are framed.
+
+    Returns:
+        tuple: The raw response, empty if the connection was closed, and the
+               perf_counter time its last byte was received.
+    """
+    data = client_socket.recv(65536)
+    received = time.perf_counter()
+    if framed:
+        while data and (len(data) < FRAME_HEADER.size or len(data) <
+                        FRAME_HEADER.size + FRAME_HEADER.unpack_from(data)[1]):
+            chunk = client_socket.recv(65536)
+            if not chunk:
+                return b"", received
+            data += chunk
+            received = time.perf_counter()
+        return data, received
+
+    while data and select.select([client_socket], [], [], QUIET_PERIOD)[0]:
+        chunk = client_socket.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+        received = time.perf_counter()
+    return data, received
+
+
+def wait_until(start, elapsed, speed):
+    """Sleep until a record is due.
+
+    Args:
+        start (float): The monotonic start time of the replay.
+        elapsed (float): The time of the record relative to the start of the
+                         capture in seconds.
+        speed (float): The speed-up factor, or None to replay as fast as
+                       possible.
+    """
+    if speed:
+        delay = start + elapsed / speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def replay_connection(host, port, records, start, speed, result, lock):
+    """Replay the records of a single captured connection.
+
+    The connection is opened when its first record is due, as the recorded
+    client did, so that it is neither closed for taking too long to register
+    nor counted against the server's connection limit too early.
+
+    Args:
+        host (str): The IP address of the server.
+        port (int): The port number of the server.
+        records (list): The (elapsed, payload) tuples of the connection.
+        start (float): The monotonic start time of the replay.
+        speed (float): The speed-up factor, or None to replay as fast as
+                       possible.
+        result (ReplayResult): The result the measurements are added to.
+        lock (threading.Lock): A lock protecting the result.
+    """
+    commands = 0
+    latencies = []
+    registered = False
+    framed = False
+    rejected = False
+    failed = False
+    wait_until(start, records[0][0], speed)
+    try:
+        with socket.create_connection((host, port)) as client_socket:
+            client_socket.settimeout(RESPONSE_TIMEOUT)
+            for elapsed, payload in records:
+                wait_until(start, elapsed, speed)
+                if not payload:
+                    # The recorded client closed its connection
+                    break
+
+                command = payload.split(b" ", 1)[0].decode(errors="replace")
+                sent = time.perf_counter()
+                client_socket.sendall(payload)
+                commands += 1
+                if not registered or command in REPLYING_COMMANDS:
+                    response, received = read_response(client_socket, framed)
+                    if response:
+                        latencies.append(received - sent)
+                    if not registered:
+                        if response.startswith(b"SUCCESS"):
+                            registered = True
+                            framed = response == \
+                                f"SUCCESS COMPRESS={COMPRESSION_METHOD}".encode()
+                        elif response.startswith(b"BUSY"):
+                            rejected = True
+                            break
+                        elif not response:
+                            # Closed by the server before registering
+                            failed = True
+                            break
+                if registered and command == "DISCONNECT":
+                    break
+    except OSError:
+        failed = True
+    with lock:
+        result.errors += failed
+        result.commands += commands
+        result.rejected += rejected
+        result.latencies.extend(latencies)
+
+
+def replay(host, port, connections, speed=1.0):
+    """Replay a capture against a server.
+
+    Args:
+        host (str): The IP address of the server.
+        port (int): The port number of the server.
+        connections (dict): The records returned by read_capture.
+        speed (float): The speed-up factor (default is 1.0, the original
+                       speed), or None to replay as fast as possible.
+
+    Returns:
+        ReplayResult: The measurements of the replay.
+    """
+    result = ReplayResult(f"{host}:{port}")
+    lock = Lock()
+    start = time.monotonic()
+    threads = [Thread(target=replay_connection,
+                      args=(host, port, records, start, speed, result, lock))
+               for records in connections.values()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result.duration = time.monotonic() - start
+    return result
+
+
+def print_report(results):
+    """Print the results of one or two replays, including the difference.
+
+    Args:
+        results (list): The ReplayResult objects to report.
+    """
+    summaries = [result.summary() for result in results]
+    header = f"{'metric':<20}" + "".join(f"{r.target:>22}" for r in results)
+    if len(results) == 2:
+        header += f"{'change':>12}"
+    print(header)
+    for key in summaries[0]:
+        line = f"{key:<20}" + "".join(f"{s[key]:>22.3f}" for s in summaries)
+        if len(results) == 2:
+            before, after = summaries[0][key], summaries[1][key]
+            if before:
+                line += f"{(after - before) / before * 100:>+11.1f}%"
+            else:
+                line += f"{'n/a':>12}"
+        print(line)
+
+
+def parse_target(target):
+    """Split a "host:port" string.
+
+    Args:
+        target (str): The server address in "host:port" form.
+
+    Returns:
+        tuple: The host and the port number.
+    """
+    host, _, port = target.rpartition(":")
+    return host, int(port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay captured chat traffic.")
+    parser.add_argument("capture", help="capture file written by the server")
+    parser.add_argument("targets", nargs="+", metavar="host:port",
+                        help="one server, or two servers to compare")
+    pace = parser.add_mutually_exclusive_group()
+    pace.add_argument("--speed", type=float, default=1.0,
+                      help="replay speed-up factor (default is 1.0)")
+    pace.add_argument("--max", action="store_true",
+                      help="replay as fast as possible")
+    args = parser.parse_args()
+
+    if len(args.targets) > 2:
+        parser.error("at most two servers can be compared")
+    try:
+        captured = read_capture(args.capture)
+    except (OSError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+
+    replay_results = []
+    for replay_target in args.targets:
+        target_host, target_port = parse_target(replay_target)
+        print(f"Replaying {len(captured)} connections against {replay_target}...")
+        replay_results.append(replay(target_host, target_port, captured,
+                                     None if args.max else args.speed))
+    print_report(replay_results)
@@ -11,13 +11,71 @@ Authors:
     Alexander Riedlinger <alexander.riedlinger@student.dhbw-vs.de>
 """
 
+import hmac
+import math
+import selectors
 import socket
 import sys
 from threading import Thread, Lock
-from collections import defaultdict
-from queue import Queue
+from collections import Counter
+from contextlib import contextmanager
 import time
 
+from chat_capture import CommandCapture
+from chat_compression import COMPRESSION_METHOD, FRAME_COMPRESSED, Compressor, \
+    plain_frame
+from chat_history import MessageHistory
+from chat_mailbox import MailboxStore
+from chat_profiling import MIN_SAMPLING_INTERVAL, DispatchHooks, PhaseTimer, \
+    SamplingProfiler, SpanTracer
+
+# Options accepted by the HISTORY command and the types of their values
+HISTORY_OPTIONS = {"after": int, "before": int, "since": float, "until": float,
+                   "limit": int, "search": str}
+MAX_HISTORY_LIMIT = 500
+
+
+class ClientSession:
+    """The state of a client connection.
+
+    Attributes:
+        client_id (str): The ID of the client.
+        client_socket (socket.socket): The socket object representing the
+                                       client connection.
+        address (tuple): A tuple containing the client's IP address and port
+                         number.
+        compressor (chat_compression.Compressor): The compressor for bulk
+                                                  responses, or None if the
+                                                  client did not ask for
+                                                  compression.
+        command (str): The command currently being handled.
+        registered (bool): Whether the client has registered its client ID
+                           and released its pending registration slot.
+        write_lock (threading.Lock): A lock serializing writes to the socket,
+                                     so that responses are never interleaved.
+    """
+
+    def __init__(self, client_id, client_socket, address, compressor=None):
+        """Initialize a new ClientSession object.
+
+        Args:
+            client_id (str): The ID of the client.
+            client_socket (socket.socket): The socket object representing the
+                                           client connection.
+            address (tuple): A tuple containing the client's IP address and
+                             port number.
+            compressor (chat_compression.Compressor): The compressor for bulk
+                                                      responses (default is
+                                                      None).
+        """
+        self.client_id = client_id
+        self.client_socket = client_socket
+        self.address = address
+        self.compressor = compressor
+        self.command = None
+        self.registered = False
+        self.write_lock = Lock()
+
 
 class ChatServer:
     """A simple chat server that allows multiple clients to connect and
@@ -28,29 +86,144 @@ class ChatServer:
         port (int): The port number to use for the server.
         clients (dict): A dictionary containing the clients currently connected
                         to the server. The keys are client IDs and the values are
-                        socket objects.
+                        ClientSession objects.
         lock (threading.Lock): A lock used to ensure thread safety.
-        message_queue (collections.defaultdict): A dictionary containing the
-                                                message queues for each connected
-                                                client. The keys are client IDs
-                                                and the values are queue.Queue objects.
+        message_queue (chat_mailbox.MailboxStore): The mailboxes of the
+                                                   connected clients, holding
+                                                   the messages not fetched
+                                                   by CHECK yet.
         running (bool): A flag indicating whether the server is currently running.
+        max_connections (int): The maximum number of simultaneously open client
+                               connections.
+        max_pending_registrations (int): The maximum number of connections that
+                                         may be waiting for registration at the
+                                         same time.
+        retry_after (int): The number of seconds rejected clients are asked to
+                           wait before connecting again.
+        backlog (int): The size of the listen backlog of the server socket.
+        registration_timeout (float): The number of seconds a connection may
+                                      take to register a client ID.
+        active_connections (int): The number of currently admitted connections.
+        pending_registrations (int): The number of admitted connections that
+                                     have not registered a client ID yet.
+        metrics (collections.Counter): Counters for admission decisions, e.g.
+                                       "connections_accepted" and
+                                       "connections_rejected_capacity".
+        capture (CommandCapture): The capture recording inbound commands, or
+                                  None if capture mode is disabled.
+        history (chat_history.MessageHistory): The history of the messages
+                                               delivered to and from connected
+                                               clients, queried by the HISTORY
+                                               command.
+        compression_threshold (int): The minimum size in bytes of a bulk
+                                     response to be compressed for clients
+                                     that negotiated compression.
+        handlers (dict): A dictionary mapping command names to the methods
+                         handling them.
+        hooks (chat_profiling.DispatchHooks): The hooks notified about the
+                                              phases of every handled command.
+        admin_token (str): The token required for ADMIN requests, or None if
+                           ADMIN requests are disabled.
+        trace_path (str): The file spans are exported to when tracing.
+        profile_path (str): The file sampled stacks are written to when
+                            profiling stops.
+        message_ttl (float): The default number of seconds after which
+                             unfetched messages expire, or None if they never
+                             expire.
     """
 
-    def __init__(self, ip_addr=socket.gethostbyname(socket.gethostname()), port=2900):
+    def __init__(self, ip_addr=socket.gethostbyname(socket.gethostname()), port=2900,
+                 max_connections=256, max_pending_registrations=32,
+                 retry_after=5, backlog=128, registration_timeout=10,
+                 capture_path=None,
+                 history_size=10000, history_conversations=10000,
+                 history_total_messages=2000000,
+                 compression_threshold=512,
+                 admin_token=None, trace_path="chat_trace.jsonl",
+                 profile_path="chat_profile.folded", message_ttl=None,
+                 mailbox_idle_timeout=300, mailbox_dir=None):
         """Initialize a new ChatServer object.
 
         Args:
             ip_addr (str): The IP address of the server (default is the local
                            machines IP address).
             port (int): The port number to use for the server (default is 2900).
+            max_connections (int): The maximum number of simultaneously open
+                                   client connections (default is 256).
+            max_pending_registrations (int): The maximum number of connections
+                                             waiting for registration (default
+                                             is 32).
+            retry_after (int): The number of seconds rejected clients are asked
+                               to wait before retrying (default is 5).
+            backlog (int): The size of the listen backlog (default is 128).
+            registration_timeout (float): The number of seconds a connection
+                                          may take to register before it is
+                                          closed (default is 10).
+            capture_path (str): If given, every inbound command is recorded to
+                                this file for later replay (default is None).
+            history_size (int): The maximum number of messages kept in the
+                                history of each conversation (default is 10000).
+            history_conversations (int): The maximum number of conversations
+                                         kept in the history (default is
+                                         10000).
+            history_total_messages (int): The maximum number of messages kept
+                                          in the history overall (default
+                                          is 2000000, about 1.4 GB).
+            compression_threshold (int): The minimum size in bytes of a bulk
+                                         response to be compressed (default
+                                         is 512).
+            admin_token (str): The token required for ADMIN requests (default
+                               is None, which disables ADMIN requests).
+            trace_path (str): The file spans are exported to when tracing
+                              (default is "chat_trace.jsonl").
+            profile_path (str): The file sampled stacks are written to
+                                (default is "chat_profile.folded").
+            message_ttl (float): The default number of seconds after which
+                                 unfetched messages expire (default is None,
+                                 messages never expire).
+            mailbox_idle_timeout (float): The number of seconds after which an
+                                          untouched mailbox is moved to disk
+                                          (default is 300), or None to keep
+                                          all mailboxes in memory.
+            mailbox_dir (str): The directory for mailboxes moved to disk
+                               (default is a temporary directory).
         """
         self.ip_addr = ip_addr
         self.port = port
         self.clients = {}
         self.lock = Lock()
-        self.message_queue = defaultdict(Queue)
+        self.message_queue = MailboxStore(mailbox_idle_timeout, mailbox_dir)
         self.running = False
+        self.max_connections = max_connections
+        self.max_pending_registrations = max_pending_registrations
+        self.retry_after = retry_after
+        self.backlog = backlog
+        self.registration_timeout = registration_timeout
+        self.active_connections = 0
+        self.pending_registrations = 0
+        self.metrics = Counter()
+        self.capture = CommandCapture(capture_path) if capture_path else None
+        self.history = MessageHistory(history_size, history_conversations,
+                                      history_total_messages)
+        self.compression_threshold = compression_threshold
+        self.handlers = {
+            "SEND": self.handle_send,
+            "SENDTTL": self.handle_send_ttl,
+            "LIST": self.handle_list,
+            "CHECK": self.handle_check,
+            "HISTORY": self.handle_history,
+            "DISCONNECT": self.handle_disconnect,
+            "ADMIN": self.handle_admin,
+        }
+        self.hooks = DispatchHooks()
+        self.admin_token = admin_token
+        self.trace_path = trace_path
+        self.profile_path = profile_path
+        self.admin_lock = Lock()
+        self.timer = None
+        self.tracer = None
+        self.profiler = None
+        self.message_ttl = message_ttl
 
     def __enter__(self):
         """
@@ -66,8 +239,8 @@ class ChatServer:
             print(e)
             self.server_socket.close()
             sys.exit(1)
-        self.server_socket.listen()
-        self.server_socket.settimeout(1)
+        self.server_socket.listen(self.backlog)
+        self.server_socket.setblocking(False)
         self.running = True
         print(f"Listening on {self.ip_addr}:{self.port}")
         return self
@@ -82,35 +255,131 @@ class ChatServer:
             traceback: The traceback (not used).
         """
         self.running = False
-        for client_socket in self.clients.values():
+        for session in self.clients.values():
             try:
-                client_socket.sendall(b"SHUTDOWN")
+                self.send_shutdown(session)
             except Exception as e:
-                print(f"Error sending SHUTDOWN to client '{client_socket}': {e}")
+                print(f"Error sending SHUTDOWN to client '{session.client_id}': {e}")
         self.server_socket.close()
+        if self.capture:
+            self.capture.close()
+        with self.lock:
+            self.message_queue.close()
+        with self.admin_lock:
+            if self.profiler:
+                self.profiler.stop()
+                self.profiler = None
+            if self.tracer:
+                self.hooks.remove(self.tracer)
+                self.tracer.close()
+                self.tracer = None
 
     def start(self):
         """
         Start the server and handle incoming client connections.
         """
-        threads = []
+        threads = [Thread(target=self.maintain_mailboxes)]
+        threads[0].start()
+        selector = selectors.DefaultSelector()
+        selector.register(self.server_socket, selectors.EVENT_READ)
         try:
             while self.running:
+                # Wake up only when a connection is ready to be accepted. The
+                # timeout merely allows checking the running flag regularly.
+                if not selector.select(timeout=1):
+                    continue
                 try:
                     client_socket, address = self.server_socket.accept()
-                    client_thread = Thread(target=self.handle_client,
-                                           args=(client_socket, address))
-                    client_thread.start()
-                    threads.append(client_thread)
-                except socket.timeout:
-                    pass
+                except (BlockingIOError, InterruptedError):
+                    continue
+                client_socket.setblocking(True)
+                if not self.admit(client_socket, address):
+                    continue
+                client_thread = Thread(target=self.serve_client,
+                                       args=(client_socket, address))
+                client_thread.start()
+                threads.append(client_thread)
+                threads = [thread for thread in threads if thread.is_alive()]
         except KeyboardInterrupt:
             print("\nStopping server due to user request")
         finally:
+            selector.close()
             self.stop()
             for thread in threads:
                 thread.join()
 
+    def maintain_mailboxes(self):
+        """
+        Expire messages and move idle mailboxes to disk once per second while
+        the server is running. Mailboxes that cannot be written to disk stay in
+        memory and are retried a second later.
+        """
+        while self.running:
+            time.sleep(1)
+            with self.lock:
+                self.metrics["messages_expired"] += self.message_queue.expire()
+                try:
+                    self.metrics["mailboxes_spilled"] += self.message_queue.spill_idle()
+                except OSError as e:
+                    self.metrics["mailbox_spill_errors"] += 1
+                    print(f"Failed to move a mailbox to disk: {e}")
+
+    def admit(self, client_socket, address):
+        """Decide whether a freshly accepted connection may be served.
+
+        Connections exceeding the configured limits are answered right away
+        with a "BUSY" reply and closed, so that no thread is spent on them.
+
+        Args:
+            client_socket (socket.socket): The socket object representing the
+                                           client connection.
+            address (tuple): A tuple containing the client's IP address and
+                             port number.
+
+        Returns:
+            bool: True if the connection was admitted, False otherwise.
+        """
+        with self.lock:
+            if self.active_connections >= self.max_connections:
+                reason = "connections_rejected_capacity"
+            elif self.pending_registrations >= self.max_pending_registrations:
+                reason = "connections_rejected_registrations"
+            else:
+                self.active_connections += 1
+                self.pending_registrations += 1
+                self.metrics["connections_accepted"] += 1
+                return True
+            self.metrics[reason] += 1
+
+        with client_socket:
+            try:
+                client_socket.sendall(f"BUSY: Server busy, retry after "
+                                      f"{self.retry_after} seconds".encode())
+            except OSError:
+                pass
+        print(f"Rejected connection from {address} ({reason})\n")
+        return False
+
+    def serve_client(self, client_socket, address):
+        """Handle an admitted client and release its slot afterwards.
+
+        Args:
+            client_socket (socket.socket): The socket object representing the
+                                           client connection.
+            address (tuple): A tuple containing the client's IP address and
+                             port number.
+        """
+        session = ClientSession(None, client_socket, address)
+        try:
+            self.handle_client(session)
+        finally:
+            if self.capture:
+                self.capture.close_connection(address)
+            with self.lock:
+                self.active_connections -= 1
+                if not session.registered:
+                    self.pending_registrations -= 1
+
     def stop(self):
         """
         Stop the server and disconnect all clients.
@@ -119,9 +388,9 @@ class ChatServer:
         countdown = 5
 
         with self.lock:
-            for client_id, client_socket in self.clients.items():
+            for client_id, session in self.clients.items():
                 try:
-                    client_socket.sendall(b"SHUTDOWN")
+                    self.send_shutdown(session)
                 except Exception as e:
                     print(f"Error sending SHUTDOWN to client '{client_id}': {e}")
 
@@ -131,96 +400,432 @@ class ChatServer:
                 countdown -= 1
 
             # Make sure everything is closed properly
-            for client_socket in self.clients.values():
-                with client_socket:
+            for session in self.clients.values():
+                with session.client_socket:
                     pass
             with self.server_socket:
                 pass
 
-    def handle_client(self, client_socket, address):
+    def handle_client(self, session):
         """Handle messages from a connected client.
 
+        When registering, a client may append " COMPRESS=zlib" to its client ID
+        to have bulk responses (CHECK, LIST and HISTORY) compressed. Afterwards
+        every request is dispatched to the handler registered for its command
+        in `handlers`; requests with unknown commands are ignored.
+
+        A client that does not register within `registration_timeout` seconds
+        is disconnected. Once registered, the client is removed again however
+        the connection ends.
+
         Args:
-            client_socket (socket.socket): The socket object representing the
-                                           client connection.
-            address (tuple): A tuple containing the client's IP address and
-                             port number.
+            session (ClientSession): The session of the admitted connection.
+                                     Its client ID, compressor and registered
+                                     flag are set on registration.
         """
+        client_socket = session.client_socket
+        address = session.address
         with client_socket:
-            while True:
-                client_id = client_socket.recv(1024).decode()
-                if not client_id:
-                    continue
+            try:
+                self.register_client(session)
+                if not session.registered:
+                    return
 
-                with self.lock:
-                    if client_id in self.clients:
-                        client_socket.send(b"ERROR: Client ID already taken. "
-                                           b"Please choose another one.")
-                    else:
-                        self.clients[client_id] = client_socket
-                        print(f"Client '{client_id}' connected from {address}\n")
-                        client_socket.send(b"SUCCESS")
-                        break
-
-            while True:
-                try:
-                    message = client_socket.recv(1024).decode()
+                while True:
+                    data = client_socket.recv(1024)
+                    if self.capture and data:
+                        self.capture.record(address, data)
+                    message = data.decode()
                     if not message:
-                        continue
-
-                    parts = message.split(" ")
-                    command = parts[0]
-
-                    if command == "SEND":
-                        recipient = parts[1]
-                        msg = " ".join(parts[2:])
-                        if recipient not in self.clients:
-                            # Message lost for unknown recipient
-                            pass
-                        else:
-                            with self.lock:
-                                self.message_queue[recipient].put((client_id, msg))
-
-                    elif command == "LIST":
-                        with self.lock:
-                            other_clients = [cid for cid in self.clients if cid
-                                             != client_id]
-                            if len(other_clients) != 0:
-                                client_socket.sendall("\n".join(other_clients)
-                                                      .encode())
-                            else:
-                                client_socket.sendall(b"Only you at the moment!")
-
-                    elif command == "CHECK":
-                        with self.lock:
-                            if client_id in self.message_queue:
-                                queue = self.message_queue[client_id]
-                                messages = []
-                                while not queue.empty():
-                                    sender, msg = queue.get()
-                                    messages.append(f"{sender}: {msg}")
-                                client_socket.sendall("\n".join(messages).encode())
-                                del self.message_queue[client_id]
-                            else:
-                                client_socket.sendall(b"EMPTY")
-
-                    elif command == "DISCONNECT":
-                        with self.lock:
-                            del self.clients[client_id]
-                            if client_id in self.message_queue:
-                                del self.message_queue[client_id]
-                                with client_socket:
-                                    pass
-                            print(f"Client '{client_id}' disconnected.\n")
+                        # Connection closed without a DISCONNECT request
                         return
 
-                except ConnectionResetError:
+                    # Unknown commands share one label, so that clients cannot
+                    # grow the statistics with arbitrary words
+                    label = message.partition(" ")[0]
+                    if label not in self.handlers:
+                        label = "UNKNOWN"
+                    with self.hooks.phase(label, "parse"):
+                        parts = message.split(" ")
+                        session.command = parts[0]
+                        handler = self.handlers.get(session.command)
+                    if handler and handler(session, parts):
+                        return
+
+            except (OSError, UnicodeDecodeError):
+                # Connection lost or garbled request, drop the client
+                pass
+            finally:
+                if session.registered:
                     with self.lock:
-                        del self.clients[client_id]
-                        if client_id in self.message_queue:
-                            del self.message_queue[client_id]
-                        print(f"Client '{client_id}' disconnected.\n")
-                    return
+                        self.clients.pop(session.client_id, None)
+                        try:
+                            self.message_queue.discard(session.client_id)
+                        except OSError as e:
+                            print(f"Failed to delete the mailbox of "
+                                  f"'{session.client_id}': {e}")
+                        print(f"Client '{session.client_id}' disconnected.\n")
+                    # The client ID may be taken by someone else next
+                    self.history.discard_client(session.client_id)
+
+    def register_client(self, session):
+        """Wait for a connected client to choose a free client ID.
+
+        Sets `session.registered` once the client ID is taken, which also
+        releases the connection's pending registration slot. Returns without
+        registering if the connection is closed or the registration deadline
+        passes.
+
+        Args:
+            session (ClientSession): The session of the admitted connection.
+        """
+        client_socket = session.client_socket
+        # One deadline for all attempts, so that retrying taken client IDs
+        # does not hold the pending registration slot forever
+        deadline = time.monotonic() + self.registration_timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    raise socket.timeout
+                client_socket.settimeout(remaining)
+                data = client_socket.recv(1024)
+            except socket.timeout:
+                with self.lock:
+                    self.metrics["registrations_timed_out"] += 1
+                return
+            if self.capture and data:
+                self.capture.record(session.address, data)
+            client_id = data.decode()
+            if not client_id:
+                # Connection closed before the client registered
+                return
+            client_id, _, method = client_id.partition(" COMPRESS=")
+            compressor = None
+            if method == COMPRESSION_METHOD:
+                compressor = Compressor(self.compression_threshold)
+
+            with self.lock:
+                if client_id in self.clients:
+                    client_socket.send(b"ERROR: Client ID already taken. "
+                                       b"Please choose another one.")
+                    continue
+                self.clients[client_id] = session
+                self.pending_registrations -= 1
+                session.client_id = client_id
+                session.compressor = compressor
+                session.registered = True
+                print(f"Client '{client_id}' connected from {session.address}\n")
+
+            client_socket.settimeout(None)
+            with session.write_lock:
+                if compressor:
+                    client_socket.send(f"SUCCESS COMPRESS={method}".encode())
+                else:
+                    client_socket.send(b"SUCCESS")
+            return
+
+    @contextmanager
+    def locked(self, session):
+        """Hold the server lock, reporting the time spent acquiring it.
+
+        Args:
+            session (ClientSession): The session of the command being handled.
+        """
+        with self.hooks.phase(session.command, "lock"):
+            self.lock.acquire()
+        try:
+            yield
+        finally:
+            self.lock.release()
+
+    def handle_send(self, session, parts):
+        """Handle a "SEND <recipient> <message>" request.
+
+        Args:
+            session (ClientSession): The session of the requesting client.
+            parts (list): The request split at spaces.
+
+        Returns:
+            bool: False, the connection stays open.
+        """
+        return self.deliver(session, parts[1:], self.message_ttl)
+
+    def handle_send_ttl(self, session, parts):
+        """Handle a "SENDTTL <seconds> <recipient> <message>" request.
+
+        The message expires if it has not been fetched within the given number
+        of seconds.
+
+        Args:
+            session (ClientSession): The session of the requesting client.
+            parts (list): The request split at spaces.
+
+        Returns:
+            bool: False, the connection stays open.
+        """
+        try:
+            ttl = float(parts[1])
+        except (IndexError, ValueError):
+            # Message lost for invalid time to live
+            return False
+        if not math.isfinite(ttl) or ttl <= 0:
+            # Message lost for invalid time to live
+            return False
+        return self.deliver(session, parts[2:], ttl)
+
+    def deliver(self, session, args, ttl):
+        """Put a message into the mailbox of its recipient.
+
+        Args:
+            session (ClientSession): The session of the sending client.
+            args (list): The recipient followed by the words of the message.
+            ttl (float): The number of seconds after which the message expires,
+                         or None if it never expires.
+
+        Returns:
+            bool: False, the connection stays open.
+        """
+        if not args:
+            return False
+        recipient = args[0]
+        msg = " ".join(args[1:])
+        with self.locked(session):
+            if recipient not in self.clients:
+                # Message lost for unknown recipient
+                return False
+            with self.hooks.phase(session.command, "mailbox"):
+                self.message_queue.put(recipient, session.client_id, msg, ttl)
+            # Recorded under the lock, so that the history of a recipient
+            # disconnecting concurrently is discarded after this message
+            self.history.add(session.client_id, recipient, msg)
+        return False
+
+    def handle_list(self, session, parts):
+        """Handle a "LIST" request by sending the IDs of all other clients.
+
+        Args:
+            session (ClientSession): The session of the requesting client.
+            parts (list): The request split at spaces.
+
+        Returns:
+            bool: False, the connection stays open.
+        """
+        with self.locked(session):
+            other_clients = [cid for cid in self.clients if cid != session.client_id]
+        if len(other_clients) != 0:
+            self.send_response(session, "\n".join(other_clients).encode(),
+                               compress=True)
+        else:
+            self.send_response(session, b"Only you at the moment!")
+        return False
+
+    def handle_check(self, session, parts):
+        """Handle a "CHECK" request by draining the client's mailbox.
+
+        Args:
+            session (ClientSession): The session of the requesting client.
+            parts (list): The request split at spaces.
+
+        Returns:
+            bool: False, the connection stays open.
+        """
+        with self.locked(session):
+            with self.hooks.phase(session.command, "mailbox"):
+                messages = [f"{sender}: {msg}" for sender, msg
+                            in self.message_queue.drain(session.client_id)]
+        if messages:
+            self.send_response(session, "\n".join(messages).encode(),
+                               compress=True)
+        else:
+            self.send_response(session, b"EMPTY")
+        return False
+
+    def handle_history(self, session, parts):
+        """Handle a "HISTORY <peer> [option=value ...]" request.
+
+        The options are after/before (sequence numbers), since/until (UNIX
+        timestamps), limit and search (a single keyword). The newest matching
+        messages are sent, one per line, prefixed with their sequence number
+        and time.
+
+        Args:
+            session (ClientSession): The session of the requesting client.
+            parts (list): The request split at spaces.
+
+        Returns:
+            bool: False, the connection stays open.
+        """
+        if len(parts) < 2 or not parts[1]:
+            self.send_response(session, b"ERROR: Usage: HISTORY <client ID> "
+                                        b"[after=N] [before=N] [since=T] "
+                                        b"[until=T] [limit=N] [search=WORD]")
+            return False
+
+        options = {}
+        for arg in parts[2:]:
+            name, _, value = arg.partition("=")
+            try:
+                options[name] = HISTORY_OPTIONS[name](value)
+            except (KeyError, ValueError):
+                self.send_response(session, f"ERROR: Invalid history option "
+                                            f"'{arg}'".encode())
+                return False
+
+        limit = min(options.pop("limit", 50), MAX_HISTORY_LIMIT)
+        keyword = options.pop("search", None)
+        with self.hooks.phase(session.command, "mailbox"):
+            entries = self.history.query(session.client_id, parts[1],
+                                         keyword=keyword, limit=limit, **options)
+        if not entries:
+            self.send_response(session, b"EMPTY")
+            return False
+
+        lines = [f"#{seq} {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))} "
+                 f"{sender}: {msg}" for seq, ts, sender, msg in entries]
+        self.send_response(session, "\n".join(lines).encode(), compress=True)
+        return False
+
+    def handle_disconnect(self, session, parts):
+        """Handle a "DISCONNECT" request by ending the connection.
+
+        Args:
+            session (ClientSession): The session of the requesting client.
+            parts (list): The request split at spaces.
+
+        Returns:
+            bool: True, the connection is closed.
+        """
+        # The client is removed by handle_client once the connection ends
+        return True
+
+    def handle_admin(self, session, parts):
+        """Handle an "ADMIN <token> <action> [argument]" request.
+
+        The actions toggle profiling and tracing of the running server:
+
+            TIMING ON|OFF       Aggregate the time spent per command and phase.
+            TRACE ON|OFF        Export every phase as a span to trace_path.
+            PROFILE ON [ms]     Start sampling all thread stacks, at least
+                                every millisecond (default is 5).
+            PROFILE OFF         Stop sampling, write the folded stacks to
+                                profile_path and reply the top functions.
+            STATS               Reply the metrics and phase timings.
+
+        Args:
+            session (ClientSession): The session of the requesting client.
+            parts (list): The request split at spaces.
+
+        Returns:
+            bool: False, the connection stays open.
+        """
+        if not self.admin_token or len(parts) < 3 or \
+                not hmac.compare_digest(parts[1].encode(), self.admin_token.encode()):
+            self.send_response(session, b"ERROR: Not authorized.")
+            return False
+
+        action = " ".join(parts[2:4]).upper()
+        with self.admin_lock:
+            if action == "TIMING ON" and not self.timer:
+                self.timer = PhaseTimer()
+                self.hooks.add(self.timer)
+                response = "OK: Timing enabled"
+            elif action == "TIMING OFF" and self.timer:
+                self.hooks.remove(self.timer)
+                response = f"OK: Timing disabled\n{self.timer.report()}"
+                self.timer = None
+            elif action == "TRACE ON" and not self.tracer:
+                # Errors of the trace file must not look like a lost connection
+                try:
+                    self.tracer = SpanTracer(self.trace_path)
+                except OSError as e:
+                    response = f"ERROR: Cannot open trace file: {e}"
+                else:
+                    self.hooks.add(self.tracer)
+                    response = f"OK: Tracing to {self.trace_path}"
+            elif action == "TRACE OFF" and self.tracer:
+                self.hooks.remove(self.tracer)
+                try:
+                    self.tracer.close()
+                except OSError as e:
+                    response = f"ERROR: Cannot write trace file: {e}"
+                else:
+                    response = "OK: Tracing disabled"
+                self.tracer = None
+            elif action == "PROFILE ON" and not self.profiler:
+                try:
+                    interval = float(parts[4]) / 1000 if len(parts) > 4 else 0.005
+                    self.profiler = SamplingProfiler(interval)
+                except ValueError:
+                    response = (f"ERROR: Invalid profiling interval, must be at "
+                                f"least {MIN_SAMPLING_INTERVAL * 1000:g} ms")
+                else:
+                    self.profiler.start()
+                    response = f"OK: Profiling every {interval * 1000:g} ms"
+            elif action == "PROFILE OFF" and self.profiler:
+                self.profiler.stop()
+                try:
+                    self.profiler.write_folded(self.profile_path)
+                except OSError as e:
+                    response = (f"ERROR: Cannot write profile: {e}\n"
+                                f"{self.profiler.report()}")
+                else:
+                    response = (f"OK: Profile written to {self.profile_path}\n"
+                                f"{self.profiler.report()}")
+                self.profiler = None
+            elif action == "STATS":
+                with self.lock:
+                    lines = [f"{name}={value}" for name, value
+                             in sorted(self.metrics.items())]
+                    lines.append(f"active_connections={self.active_connections}")
+                    lines.append(f"mailboxes_hot={len(self.message_queue.hot)}")
+                    lines.append(f"mailboxes_cold={len(self.message_queue.cold)}")
+                if self.timer:
+                    lines.append(self.timer.report())
+                response = "\n".join(lines)
+            else:
+                response = f"ERROR: Invalid or redundant admin action '{action}'"
+        self.send_response(session, response.encode(), compress=True)
+        return False
+
+    def send_shutdown(self, session):
+        """Notify a client that the server shuts down.
+
+        The notification is framed if the client negotiated compression, and
+        is not written into the middle of a response being sent.
+
+        Args:
+            session (ClientSession): The session of the client.
+        """
+        data = plain_frame(b"SHUTDOWN") if session.compressor else b"SHUTDOWN"
+        with session.write_lock:
+            session.client_socket.sendall(data)
+
+    def send_response(self, session, data, compress=False):
+        """Send a response to a client.
+
+        Bulk responses are compressed if the client negotiated compression.
+        All responses to such a client are framed. The write holds the
+        session's write lock, as SHUTDOWN may be sent from another thread.
+
+        Args:
+            session (ClientSession): The session of the client.
+            data (bytes): The uncompressed response.
+            compress (bool): Whether the response is a bulk response that may
+                             be compressed (default is False).
+        """
+        if session.compressor and not compress:
+            data = plain_frame(data)
+        elif session.compressor:
+            packed = session.compressor.pack(data)
+            if packed[0] == FRAME_COMPRESSED:
+                with self.lock:
+                    self.metrics["compressed_responses"] += 1
+                    self.metrics["compressed_bytes_in"] += len(data)
+                    self.metrics["compressed_bytes_out"] += len(packed)
+            data = packed
+        with self.hooks.phase(session.command, "write"), session.write_lock:
+            session.client_socket.sendall(data)
 
 
 if __name__ == '__main__':
@@ -228,6 +833,9 @@ if __name__ == '__main__':
     default_ip = socket.gethostbyname(socket.gethostname())
     server_ip = input(f"IP-Address (local, default={default_ip}): ") or default_ip
     server_port = int(input("Port (default=2900): ") or "2900")
+    capture_file = input("Capture file (optional, default=none): ") or None
+    token = input("Admin token (optional, default=none): ") or None
 
-    with ChatServer(server_ip, server_port) as server:
+    with ChatServer(server_ip, server_port, capture_path=capture_file,
+                    admin_token=token) as server:
         server.start()